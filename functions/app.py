@@ -1,4 +1,4 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 
 app = Flask(__name__)
 
@@ -9,8 +9,6 @@ def index():
 
 
 def handler(event, context):
-    from flask import request
-
     with app.test_request_context(
         path=event["path"],
         base_url=event["headers"]["x-forwarded-proto"]
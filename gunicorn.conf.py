@@ -0,0 +1,23 @@
+import os
+
+# Worker con hilos: sirve los archivos con sendfile() vía wsgi.file_wrapper
+worker_class = "gthread"
+
+# Un solo proceso: el estado de las descargas (progreso, procesos, cancelaciones)
+# vive en memoria y no se comparte entre procesos
+workers = 1
+
+# Presupuesto de hilos: cada stream SSE abierto (/yt/progress/<id>/stream) ocupa
+# un hilo durante hasta PROGRESS_STREAM_MAX_SECONDS (main.py). Debe quedar
+# bastante por encima del número esperado de clientes siguiendo el progreso
+# para que /yt, /yt/download y /yt/cancel sigan respondiendo. Las descargas
+# corren en su propio pool (MAX_DOWNLOAD_WORKERS) y no cuentan aquí.
+threads = int(os.environ.get("GUNICORN_THREADS", "64"))
+
+
+def post_worker_init(worker):
+    # main solo arranca la limpieza periódica con __main__: bajo gunicorn se
+    # inicia aquí para retirar los archivos que no se llegaron a enviar completos
+    from main import start_cleanup_scheduler
+
+    start_cleanup_scheduler()
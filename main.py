@@ -1,14 +1,38 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
+from flask.json.provider import DefaultJSONProvider, JSONProvider
 from flask_cors import CORS
+import orjson
 import yt_dlp
 import os
+import platform
+import re
+import shutil
+import subprocess
 import time
 import threading
 import signal
 import psutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 
+
+class OrjsonProvider(JSONProvider):
+    """Serializar las respuestas JSON con orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj,
+            default=DefaultJSONProvider.default,
+            option=orjson.OPT_NON_STR_KEYS,
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Configuración
@@ -16,18 +40,90 @@ DOWNLOAD_FOLDER = "downloads"
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
+# Pool de descargas con concurrencia limitada
+MAX_DOWNLOAD_WORKERS = int(os.environ.get("MAX_DOWNLOAD_WORKERS", "4"))
+_POOL = ThreadPoolExecutor(
+    max_workers=MAX_DOWNLOAD_WORKERS, thread_name_prefix="ytdl"
+)
+
+# Opciones comunes de descarga: fragmentos HLS/DASH en paralelo y
+# peticiones por rangos para formatos progresivos
+DOWNLOAD_OPTS = {
+    "concurrent_fragment_downloads": 8,
+    "http_chunk_size": 10485760,
+    "retries": 3,
+    "fragment_retries": 5,
+}
+
+# Caracteres no permitidos en el nombre del archivo descargado
+# (\w equivale a str.isalnum() más "_")
+_UNSAFE_TITLE_CHARS = re.compile(r"[^\w \-|.]")
+
 # Diccionario para almacenar el progreso de las descargas
 download_progress = {}
 download_processes = {}
 download_threads = {}
 download_cancel_flags = {}
 
+# Lock para las secuencias que modifican varios diccionarios de estado
+_STATE_LOCK = threading.RLock()
+
+# Streams SSE de progreso: segundos entre keepalives y duración máxima.
+# Cada stream abierto ocupa un hilo de gunicorn (ver threads en gunicorn.conf.py)
+PROGRESS_STREAM_KEEPALIVE = 15
+PROGRESS_STREAM_MAX_SECONDS = 120
+FINAL_STATUSES = ("completed", "error", "cancelled", "not_found")
+
+
+class ProgressSignal:
+    """Aviso de cambios de progreso para los clientes de un video"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.subscribers = 0
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        """Esperar a que cambie la versión; devuelve la versión actual"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+
+# Señales por video, creadas solo cuando hay clientes suscritos
+progress_signals = {}
+
+
+def notify_progress(video_id):
+    """Despertar a los clientes suscritos al progreso de un video"""
+    progress_signal = progress_signals.get(video_id)
+    if progress_signal is not None:
+        progress_signal.notify()
+
+
+# Caché de metadatos
+# (url -> (timestamp, info, índice format_id -> formato))
+INFO_CACHE_TTL = 60
+_INFO_CACHE = {}
+_INFO_CACHE_LOCK = threading.Lock()
+# Un lock por URL para que varias peticiones de la misma URL extraigan una vez
+_EXTRACT_LOCKS = {}
+# Un extractor por hilo: YoutubeDL no es seguro entre hilos y así las
+# extracciones de URLs distintas no se bloquean entre sí
+_YDL_LOCAL = threading.local()
+
 
 class ProgressHook:
     def __init__(self, video_id, stage="video"):
         self.video_id = video_id
         self.stage = stage
         self.start_time = time.time()
+        self._last_emit = 0.0
 
     def __call__(self, d):
         # Verificar si la descarga fue cancelada
@@ -38,13 +134,18 @@ class ProgressHook:
             raise Exception("Descarga cancelada por el usuario")
 
         if d["status"] == "downloading":
+            # Limitar las actualizaciones a una cada 250 ms
+            now = time.time()
+            if now - self._last_emit < 0.25:
+                return
+            self._last_emit = now
+
             try:
                 total = d.get("total_bytes", 0) or d.get("total_bytes_estimate", 0)
                 downloaded = d.get("downloaded_bytes", 0)
                 speed = d.get("speed", 0)
                 if total and downloaded:
                     progress = (downloaded / total) * 100
-                    elapsed_time = time.time() - self.start_time
                     eta = (total - downloaded) / speed if speed > 0 else 0
 
                     # Actualizar progreso según la etapa
@@ -59,17 +160,18 @@ class ProgressHook:
                         progress * 0.45 if self.stage != "merging" else progress * 0.1
                     )
 
-                    download_progress[self.video_id].update(
-                        {
-                            "status": f"{self.stage}_downloading",
-                            "progress": round(adjusted_progress, 2),
-                            "speed": f"{speed/1024/1024:.2f} MB/s",
-                            "elapsed": round(elapsed_time, 2),
-                            "eta": round(eta, 2),
-                            "size_downloaded": f"{downloaded/1024/1024:.2f}MB",
-                            "size_total": f"{total/1024/1024:.2f}MB",
-                        }
-                    )
+                    # Construir el nuevo estado y reemplazarlo de una sola vez
+                    # para que /yt/progress nunca lea un estado a medias
+                    download_progress[self.video_id] = {
+                        **download_progress[self.video_id],
+                        "status": f"{self.stage}_downloading",
+                        "progress": round(adjusted_progress, 2),
+                        "speed": f"{speed/1024/1024:.2f} MB/s",
+                        "elapsed": round(now - self.start_time, 2),
+                        "eta": round(eta, 2),
+                        "size_downloaded": f"{downloaded/1024/1024:.2f}MB",
+                        "size_total": f"{total/1024/1024:.2f}MB",
+                    }
 
                     # Verificar cancelación después de cada actualización
                     if (
@@ -96,35 +198,186 @@ class ProgressHook:
         elif d["status"] == "error":
             download_progress[self.video_id]["status"] = "error"
 
+        notify_progress(self.video_id)
+
 
 def format_duration(seconds):
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    seconds = seconds % 60
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
 
     if hours > 0:
         return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
     return f"{minutes:02d}:{seconds:02d}"
 
 
+_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+
 def format_size(bytes):
-    for unit in ["B", "KB", "MB", "GB"]:
-        if bytes < 1024:
-            return f"{bytes:.1f}{unit}"
-        bytes /= 1024
-    return f"{bytes:.1f}TB"
+    # Cada unidad equivale a 10 bits más de tamaño
+    i = 0 if bytes < 1024 else min((int(bytes).bit_length() - 1) // 10, 4)
+    return f"{bytes / (1 << (10 * i)):.1f}{_SIZE_UNITS[i]}"
 
 
-def optimize_ffmpeg_settings(format_ext):
-    """Optimizar configuración de FFmpeg según el formato"""
-    if format_ext in ["mp4", "mkv"]:
+_NVENC_AVAILABLE = None
+_NVENC_LOCK = threading.Lock()
+
+
+def has_nvenc():
+    """Comprobar (una sola vez) si h264_nvenc puede codificar en este equipo"""
+    global _NVENC_AVAILABLE
+    if _NVENC_AVAILABLE is not None:
+        return _NVENC_AVAILABLE
+    # Un solo hilo hace la prueba; el resto espera su resultado
+    with _NVENC_LOCK:
+        if _NVENC_AVAILABLE is None:
+            # Que FFmpeg liste el codificador no implica que haya GPU: codificar
+            # un fotograma de prueba para confirmarlo
+            try:
+                result = subprocess.run(
+                    [
+                        "ffmpeg",
+                        "-hide_banner",
+                        "-loglevel",
+                        "error",
+                        "-f",
+                        "lavfi",
+                        "-i",
+                        "nullsrc=s=64x64",
+                        "-frames:v",
+                        "1",
+                        "-c:v",
+                        "h264_nvenc",
+                        "-f",
+                        "null",
+                        "-",
+                    ],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=30,
+                )
+                _NVENC_AVAILABLE = result.returncode == 0
+            except Exception:
+                _NVENC_AVAILABLE = False
+    return _NVENC_AVAILABLE
+
+
+def h264_encoder_args(hardware=True):
+    """Argumentos de codificación H.264, usando NVENC si está disponible"""
+    if hardware and has_nvenc():
         return [
             "-c:v",
-            "libx264",
+            "h264_nvenc",
             "-preset",
-            "fast",  # Usar 'faster' o 'veryfast' para más velocidad
-            "-crf",
-            "23",  # Balance entre calidad y tamaño
+            "p4",
+            "-tune",
+            "hq",
+            "-b:v",
+            "5M",
+        ]
+    return [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "fast",  # Usar 'faster' o 'veryfast' para más velocidad
+        "-crf",
+        "23",  # Balance entre calidad y tamaño
+    ]
+
+
+def is_h264(codec):
+    """Codec H.264 según ffprobe ('h264') o yt-dlp ('avc1.640028')"""
+    return bool(codec) and codec.split(".")[0] in ("h264", "avc1", "avc3")
+
+
+def is_aac(codec):
+    """Codec AAC según ffprobe ('aac') o yt-dlp ('mp4a.40.2')"""
+    return bool(codec) and codec.split(".")[0] in ("aac", "mp4a")
+
+
+def merge_codec_args(copy_video, copy_audio, hardware=True):
+    """Argumentos de FFmpeg para unir video y audio en MP4
+
+    Los streams que ya son H.264/AAC se copian; el resto se recodifica.
+    """
+    video_args = ["-c:v", "copy"] if copy_video else h264_encoder_args(hardware)
+    audio_args = ["-c:a", "copy"] if copy_audio else ["-c:a", "aac", "-b:a", "192k"]
+    return video_args + audio_args
+
+
+def probe_codec(path, stream):
+    """Obtener el codec de un stream (p. ej. 'v:0' o 'a:0') con ffprobe"""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                stream,
+                "-show_entries",
+                "stream=codec_name",
+                "-of",
+                "csv=p=0",
+                path,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        return result.stdout.strip() or None
+    except Exception:
+        return None
+
+
+FFMPEG_STDERR_LINES = 200
+
+
+def run_ffmpeg(ffmpeg_cmd, video_id):
+    """Ejecutar FFmpeg guardando la referencia al proceso para poder cancelarlo"""
+    # Mostrar solo errores y sin estadísticas de progreso
+    ffmpeg_cmd = [ffmpeg_cmd[0], "-loglevel", "error", "-nostats"] + ffmpeg_cmd[1:]
+
+    # Configurar creación de proceso según el sistema operativo
+    if platform.system() == "Windows":
+        process = subprocess.Popen(
+            ffmpeg_cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP,
+        )
+    else:
+        process = subprocess.Popen(
+            ffmpeg_cmd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            start_new_session=True,  # setsid sin preexec_fn
+        )
+
+    with _STATE_LOCK:
+        download_processes[video_id] = process
+
+    # Conservar solo las últimas líneas de stderr para el mensaje de error
+    stderr_tail = deque(maxlen=FFMPEG_STDERR_LINES)
+
+    def read_stderr():
+        for line in process.stderr:
+            stderr_tail.append(line.decode(errors="replace").rstrip())
+        process.stderr.close()
+
+    reader = threading.Thread(target=read_stderr, daemon=True)
+    reader.start()
+
+    # Esperar a que termine el proceso
+    process.wait()
+    reader.join()
+    return process, "\n".join(stderr_tail)
+
+
+def optimize_ffmpeg_settings(format_ext):
+    """Optimizar configuración de FFmpeg según el formato"""
+    if format_ext in ["mp4", "mkv"]:
+        return h264_encoder_args() + [
             "-c:a",
             "aac",
             "-b:a",
@@ -170,94 +423,166 @@ def get_best_audio_format(formats):
 def process_formats(formats):
     """Procesar y filtrar formatos únicos"""
     seen_qualities = set()
-    processed_formats = {"videoOnly": [], "audioOnly": [], "combined": []}
+    buckets = {"videoOnly": [], "audioOnly": [], "combined": []}
 
-    # Ordenar formatos por calidad y tamaño
+    # Clasificar cada formato en una sola pasada
     for f in formats:
+        vcodec = f.get("vcodec", "none")
+        acodec = f.get("acodec", "none")
+        has_video = vcodec != "none"
+        has_audio = acodec != "none"
+        if has_video and has_audio:
+            bucket = "combined"
+        elif has_video:
+            bucket = "videoOnly"
+        elif has_audio:
+            bucket = "audioOnly"
+        else:
+            continue
+
+        quality = (
+            f.get("resolution", "N/A")
+            if f.get("resolution")
+            else f.get("format_note", "N/A")
+        )
+        container = f.get("ext", "")
+
+        # Filtrar formatos duplicados antes de construir la entrada
+        quality_key = (quality, container)
+        if quality_key in seen_qualities:
+            continue
+        seen_qualities.add(quality_key)
+
+        raw_size = f.get("filesize") or 0
+        fps = f.get("fps", 0)
         format_info = {
             "itag": f.get("format_id"),
-            "quality": (
-                f.get("resolution", "N/A")
-                if f.get("resolution")
-                else f.get("format_note", "N/A")
-            ),
-            "container": f.get("ext", ""),
-            "size": format_size(f.get("filesize", 0)) if f.get("filesize") else "N/A",
-            "raw_size": f.get("filesize", 0),
-            "vcodec": f.get("vcodec", "none"),
-            "acodec": f.get("acodec", "none"),
-            "fps": f.get("fps", 0),
+            "quality": quality,
+            "container": container,
+            "size": format_size(raw_size) if raw_size else "N/A",
+            "raw_size": raw_size,
+            "vcodec": vcodec,
+            "acodec": acodec,
+            "fps": fps,
             "format_note": f.get("format_note", ""),
         }
 
-        quality_key = f"{format_info['quality']}_{format_info['container']}"
-
-        # Filtrar formatos duplicados y organizar por tipo
-        if format_info["vcodec"] != "none" and format_info["acodec"] != "none":
-            if quality_key not in seen_qualities:
-                seen_qualities.add(quality_key)
-                processed_formats["combined"].append(format_info)
-        elif format_info["vcodec"] != "none" and format_info["acodec"] == "none":
-            if quality_key not in seen_qualities:
-                seen_qualities.add(quality_key)
-                processed_formats["videoOnly"].append(format_info)
-        elif format_info["vcodec"] == "none" and format_info["acodec"] != "none":
-            if quality_key not in seen_qualities:
-                seen_qualities.add(quality_key)
-                processed_formats["audioOnly"].append(format_info)
-
-    # Ordenar formatos por calidad
-    for key in processed_formats:
-        processed_formats[key].sort(
-            key=lambda x: (
-                int(x.get("raw_size", 0)) if x.get("raw_size") else 0,
-                x.get("fps", 0),
-            ),
-            reverse=True,
-        )
+        buckets[bucket].append(((int(raw_size), fps or 0), format_info))
+
+    # Ordenar cada grupo una sola vez por tamaño y fps
+    return {
+        key: [t[1] for t in sorted(items, key=lambda t: t[0], reverse=True)]
+        for key, items in buckets.items()
+    }
+
+
+def index_formats(formats):
+    """Indexar formatos de yt-dlp por format_id (conserva el primero)"""
+    index = {}
+    for f in formats:
+        index.setdefault(f.get("format_id"), f)
+    return index
+
+
+def _metadata_ydl():
+    """Extractor de metadatos reutilizado dentro del hilo actual"""
+    ydl = getattr(_YDL_LOCAL, "ydl", None)
+    if ydl is None:
+        ydl = _YDL_LOCAL.ydl = yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True})
+    return ydl
+
+
+def _fresh_cache_entry(url):
+    """Entrada de la caché para la URL si no ha expirado"""
+    with _INFO_CACHE_LOCK:
+        cached = _INFO_CACHE.get(url)
+    if cached and time.time() - cached[0] < INFO_CACHE_TTL:
+        return cached
+    return None
+
+
+def _cached_entry(url):
+    """Extraer información del video reutilizando resultados recientes"""
+    cached = _fresh_cache_entry(url)
+    if cached:
+        return cached
+
+    with _INFO_CACHE_LOCK:
+        url_lock = _EXTRACT_LOCKS.setdefault(url, threading.Lock())
+
+    with url_lock:
+        try:
+            # Otro hilo pudo haber extraído la URL mientras esperábamos
+            cached = _fresh_cache_entry(url)
+            if cached:
+                return cached
 
-    return processed_formats
+            info = _metadata_ydl().extract_info(url, download=False)
+            now = time.time()
+            entry = (now, info, index_formats(info.get("formats", [])))
+
+            with _INFO_CACHE_LOCK:
+                # Descartar entradas expiradas para que la caché no crezca
+                for key, old_entry in list(_INFO_CACHE.items()):
+                    if now - old_entry[0] >= INFO_CACHE_TTL:
+                        _INFO_CACHE.pop(key, None)
+                _INFO_CACHE[url] = entry
+            return entry
+        finally:
+            with _INFO_CACHE_LOCK:
+                if _EXTRACT_LOCKS.get(url) is url_lock:
+                    del _EXTRACT_LOCKS[url]
+
+
+def _cached_extract(url):
+    """Obtener la información del video desde la caché"""
+    return _cached_entry(url)[1]
+
+
+def info_for_download(info):
+    """Copia de la información en caché lista para volver a procesarla
+
+    La información en caché ya pasó por la selección de formato por defecto;
+    se eliminan las claves privadas (requested_formats, filepath, ...) igual
+    que hace --load-info-json para que se respete el formato pedido.
+    """
+    return yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
 
 
 def get_video_info(url):
     """Obtener información del video"""
     try:
-        ydl_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "extract_flat": False,
-        }
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            formats = process_formats(info.get("formats", []))
+        info = _cached_extract(url)
+        formats = process_formats(info.get("formats", []))
 
-            thumbnails = info.get("thumbnails", [])
-            thumbnails.sort(
-                key=lambda x: x.get("height", 0) * x.get("width", 0), reverse=True
-            )
+        # Ordenar una copia para no modificar la información en caché
+        thumbnails = sorted(
+            info.get("thumbnails", []),
+            key=lambda x: (x.get("height") or 0) * (x.get("width") or 0),
+            reverse=True,
+        )
 
-            return {
-                "success": True,
-                "data": {
-                    "title": info.get("title", ""),
-                    "duration": {
-                        "seconds": info.get("duration", 0),
-                        "formatted": format_duration(info.get("duration", 0)),
-                    },
-                    "thumbnails": thumbnails,
-                    "formats": formats,
-                    "author": {
-                        "name": info.get("uploader", ""),
-                        "url": info.get("uploader_url", ""),
-                    },
-                    "statistics": {
-                        "views": info.get("view_count", 0),
-                        "likes": info.get("like_count", 0),
-                    },
-                    "description": info.get("description", ""),
+        return {
+            "success": True,
+            "data": {
+                "title": info.get("title", ""),
+                "duration": {
+                    "seconds": info.get("duration", 0),
+                    "formatted": format_duration(info.get("duration", 0)),
                 },
-            }
+                "thumbnails": thumbnails,
+                "formats": formats,
+                "author": {
+                    "name": info.get("uploader", ""),
+                    "url": info.get("uploader_url", ""),
+                },
+                "statistics": {
+                    "views": info.get("view_count", 0),
+                    "likes": info.get("like_count", 0),
+                },
+                "description": info.get("description", ""),
+            },
+        }
     except Exception as e:
         return {"success": False, "error": str(e)}
 
@@ -265,9 +590,8 @@ def get_video_info(url):
 def get_available_formats(url):
     """Obtener lista de formatos disponibles para el video"""
     try:
-        with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return info.get("formats", [])
+        info = _cached_extract(url)
+        return info.get("formats", [])
     except Exception as e:
         return []
 
@@ -299,6 +623,12 @@ def get_best_audio_for_format(formats, video_format):
     if not audio_formats:
         return None
 
+    # Con video H.264 preferir AAC, que se puede copiar en el MP4 sin recodificar
+    if video_format and is_h264(video_format.get("vcodec")):
+        aac_formats = [f for f in audio_formats if is_aac(f.get("acodec"))]
+        if aac_formats:
+            audio_formats = aac_formats
+
     # Ordenar por calidad y tamaño
     return max(
         audio_formats,
@@ -306,15 +636,13 @@ def get_best_audio_for_format(formats, video_format):
     )
 
 
-def ensure_audio_video_format(format_id, formats):
+def ensure_audio_video_format(format_id, formats, formats_index=None):
     """Asegurar que el formato tenga video y audio"""
-    selected_format = None
+    if formats_index is None:
+        formats_index = index_formats(formats)
 
     # Buscar el formato seleccionado
-    for f in formats:
-        if f.get("format_id") == format_id:
-            selected_format = f
-            break
+    selected_format = formats_index.get(format_id)
 
     if not selected_format:
         return "best"  # Formato por defecto si no se encuentra
@@ -351,15 +679,21 @@ def download_and_merge(url, video_format, audio_format, output_path, video_id):
         video_path = None
         audio_path = None
 
+        # Extraer la información una sola vez y reutilizarla en ambas etapas
+        info = _cached_extract(url)
+
         # Descargar video
         try:
             video_opts = {
                 "format": video_format,
                 "outtmpl": temp_video,
                 "progress_hooks": [ProgressHook(video_id, "video")],
+                **DOWNLOAD_OPTS,
             }
             with yt_dlp.YoutubeDL(video_opts) as ydl:
-                video_info = ydl.extract_info(url, download=True)
+                video_info = ydl.process_ie_result(
+                    info_for_download(info), download=True
+                )
                 video_path = ydl.prepare_filename(video_info)
 
                 # Verificar si la descarga fue cancelada
@@ -383,9 +717,12 @@ def download_and_merge(url, video_format, audio_format, output_path, video_id):
                 "format": audio_format,
                 "outtmpl": temp_audio,
                 "progress_hooks": [ProgressHook(video_id, "audio")],
+                **DOWNLOAD_OPTS,
             }
             with yt_dlp.YoutubeDL(audio_opts) as ydl:
-                audio_info = ydl.extract_info(url, download=True)
+                audio_info = ydl.process_ie_result(
+                    info_for_download(info), download=True
+                )
                 audio_path = ydl.prepare_filename(audio_info)
 
                 # Verificar si la descarga fue cancelada
@@ -406,53 +743,32 @@ def download_and_merge(url, video_format, audio_format, output_path, video_id):
         # Actualizar estado a unión
         download_progress[video_id].update({"status": "merging", "progress": 90})
 
-        # Construir comando FFmpeg
-        ffmpeg_cmd = [
-            "ffmpeg",
-            "-i",
-            video_path,
-            "-i",
-            audio_path,
-            "-c:v",
-            "libx264",  # Codec de video H.264
-            "-preset",
-            "fast",  # Preset de codificación
-            "-crf",
-            "23",  # Calidad de video (menor = mejor calidad)
-            "-c:a",
-            "aac",  # Codec de audio AAC
-            "-b:a",
-            "192k",  # Bitrate de audio
-            "-movflags",
-            "+faststart",  # Optimizar para reproducción web
-            "-y",  # Sobrescribir archivo si existe
-            output_path,
-        ]
-
-        # Ejecutar FFmpeg y guardar referencia al proceso
-        import subprocess
-        import platform
-
-        # Configurar creación de proceso según el sistema operativo
-        if platform.system() == "Windows":
-            process = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP,
-            )
-        else:
-            process = subprocess.Popen(
-                ffmpeg_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                preexec_fn=os.setsid,
+        def merge_cmd(codec_args):
+            return (
+                ["ffmpeg", "-i", video_path, "-i", audio_path]
+                + codec_args
+                + [
+                    "-movflags",
+                    "+faststart",  # Optimizar para reproducción web
+                    "-y",  # Sobrescribir archivo si existe
+                    output_path,
+                ]
             )
 
-        download_processes[video_id] = process
+        # Copiar los streams que ya son H.264/AAC y recodificar solo el resto
+        copy_video = is_h264(probe_codec(video_path, "v:0"))
+        copy_audio = is_aac(probe_codec(audio_path, "a:0"))
+        ffmpeg_cmd = merge_cmd(merge_codec_args(copy_video, copy_audio))
+        process, stderr = run_ffmpeg(ffmpeg_cmd, video_id)
 
-        # Esperar a que termine el proceso
-        stdout, stderr = process.communicate()
+        # Si falla la copia o NVENC, recodificar todo con libx264
+        fallback_cmd = merge_cmd(merge_codec_args(False, False, hardware=False))
+        if (
+            process.returncode != 0
+            and fallback_cmd != ffmpeg_cmd
+            and not download_cancel_flags.get(video_id)
+        ):
+            process, stderr = run_ffmpeg(fallback_cmd, video_id)
 
         # Verificar si el proceso fue cancelado o tuvo error
         if video_id in download_progress and (
@@ -463,7 +779,7 @@ def download_and_merge(url, video_format, audio_format, output_path, video_id):
             error_msg = (
                 "Descarga cancelada por el usuario"
                 if download_progress[video_id].get("status") == "cancelled"
-                else f"Error en FFmpeg: {stderr.decode()}"
+                else f"Error en FFmpeg: {stderr}"
             )
 
             if "cancelled" not in error_msg:
@@ -473,8 +789,7 @@ def download_and_merge(url, video_format, audio_format, output_path, video_id):
             raise Exception(error_msg)
 
         # Limpiar referencia al proceso
-        if video_id in download_processes:
-            del download_processes[video_id]
+        download_processes.pop(video_id, None)
 
         # Actualizar estado a completado
         download_progress[video_id].update({"status": "completed", "progress": 100})
@@ -502,11 +817,10 @@ def download_and_merge(url, video_format, audio_format, output_path, video_id):
             print(f"Error eliminando audio temporal: {e}")
 
         # Limpiar proceso si existe
-        if video_id in download_processes:
-            try:
-                del download_processes[video_id]
-            except:
-                pass
+        with _STATE_LOCK:
+            download_processes.pop(video_id, None)
+
+        notify_progress(video_id)
 
 
 @app.route("/yt", methods=["GET"])
@@ -528,6 +842,66 @@ def get_progress(video_id):
     return jsonify({"status": "not_found"})
 
 
+@app.route("/yt/progress/<video_id>/stream", methods=["GET"])
+def stream_progress(video_id):
+    """Endpoint SSE que envía el progreso solo cuando cambia"""
+
+    def generate():
+        # Registrar la señal solo para descargas conocidas y mientras el
+        # stream esté abierto, para que progress_signals no crezca sin límite
+        with _STATE_LOCK:
+            if video_id not in download_progress:
+                progress_signal = None
+            else:
+                progress_signal = progress_signals.setdefault(
+                    video_id, ProgressSignal()
+                )
+                progress_signal.subscribers += 1
+
+        if progress_signal is None:
+            yield f"data: {orjson.dumps({'status': 'not_found'}).decode()}\n\n"
+            return
+
+        try:
+            # Limitar la duración para no ocupar un hilo del servidor
+            # indefinidamente; EventSource se reconecta solo
+            deadline = time.time() + PROGRESS_STREAM_MAX_SECONDS
+            last_payload = None
+            version = progress_signal.version
+            while True:
+                state = download_progress.get(video_id, {"status": "not_found"})
+                payload = orjson.dumps(state).decode()
+                if payload != last_payload:
+                    last_payload = payload
+                    yield f"data: {payload}\n\n"
+
+                if state.get("status") in FINAL_STATUSES or time.time() >= deadline:
+                    break
+
+                # Esperar a la siguiente actualización; si no llega ninguna,
+                # enviar un comentario para detectar clientes desconectados
+                new_version = progress_signal.wait(
+                    version, PROGRESS_STREAM_KEEPALIVE
+                )
+                if new_version == version:
+                    yield ": keepalive\n\n"
+                version = new_version
+        finally:
+            with _STATE_LOCK:
+                progress_signal.subscribers -= 1
+                if (
+                    progress_signal.subscribers == 0
+                    and progress_signals.get(video_id) is progress_signal
+                ):
+                    del progress_signals[video_id]
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/yt/download", methods=["POST"])
 def download():
     """Endpoint para iniciar la descarga de un video"""
@@ -540,17 +914,11 @@ def download():
         itag = data["itag"]
         video_id = f"{int(time.time())}"
 
-        # Obtener formatos disponibles
-        with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            formats = info["formats"]
+        # Obtener formatos disponibles (reutiliza la extracción de /yt)
+        _, info, formats_index = _cached_entry(url)
 
         # Encontrar el formato seleccionado
-        selected_format = None
-        for f in formats:
-            if f.get("format_id") == itag:
-                selected_format = f
-                break
+        selected_format = formats_index.get(itag)
 
         # Determinar si es una descarga de solo audio
         is_audio_only = selected_format and selected_format.get("vcodec") == "none"
@@ -575,6 +943,7 @@ def download():
                 "keepvideo": False,  # No mantener el archivo original
                 "writethumbnail": False,  # No guardar thumbnail
                 "final_filepath": final_path,  # Guardar la ruta final
+                **DOWNLOAD_OPTS,
             }
             download_progress[video_id] = {
                 "status": "starting",
@@ -585,33 +954,32 @@ def download():
             }
         else:
             output_path = os.path.join(DOWNLOAD_FOLDER, f"video_{video_id}.mp4")
-            format_string = (
-                f"{itag}+bestaudio/best"
-                if selected_format.get("acodec") == "none"
-                else itag
-            )
+            format_string = itag
+            merge_args = None
+            if selected_format.get("acodec") == "none":
+                # Elegir el audio aquí para saber qué streams se pueden copiar
+                best_audio = get_best_audio_for_format(
+                    info.get("formats", []), selected_format
+                )
+                if best_audio:
+                    format_string = f"{itag}+{best_audio['format_id']}/best"
+                    merge_args = merge_codec_args(
+                        is_h264(selected_format.get("vcodec")),
+                        is_aac(best_audio.get("acodec")),
+                    )
+                else:
+                    format_string = f"{itag}+bestaudio/best"
+                    merge_args = merge_codec_args(False, False)
             ydl_opts = {
                 "format": format_string,
                 "outtmpl": output_path,
                 "progress_hooks": [ProgressHook(video_id)],
                 "merge_output_format": "mp4",
-                "postprocessor_args": {
-                    "ffmpeg": [
-                        "-c:v",
-                        "libx264",
-                        "-preset",
-                        "fast",
-                        "-crf",
-                        "23",
-                        "-c:a",
-                        "aac",
-                        "-b:a",
-                        "192k",
-                        "-movflags",
-                        "+faststart",
-                    ]
-                },
+                **DOWNLOAD_OPTS,
             }
+            if merge_args:
+                # Solo para el merger de yt-dlp (ya añade -movflags +faststart)
+                ydl_opts["postprocessor_args"] = {"merger": merge_args}
             download_progress[video_id] = {
                 "status": "starting",
                 "progress": 0,
@@ -621,15 +989,15 @@ def download():
 
         def download_thread():
             try:
+                # Descargar a partir de la información ya extraída en lugar
+                # de volver a consultar la URL
                 with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    ydl.download([url])
+                    ydl.process_ie_result(info_for_download(info), download=True)
 
                 if is_audio_only:
                     # Renombrar el archivo si es necesario
                     temp_mp3 = f"{temp_path}.mp3"
                     if os.path.exists(temp_mp3):
-                        import shutil
-
                         shutil.move(temp_mp3, final_path)
 
                 download_progress[video_id].update(
@@ -638,10 +1006,10 @@ def download():
             except Exception as e:
                 download_progress[video_id].update({"status": "error", "error": str(e)})
                 print(f"Error en la descarga: {str(e)}")
+            finally:
+                notify_progress(video_id)
 
-        thread = threading.Thread(target=download_thread)
-        thread.start()
-        download_threads[video_id] = thread
+        download_threads[video_id] = _POOL.submit(download_thread)
 
         return jsonify(
             {"success": True, "message": "Descarga iniciada", "video_id": video_id}
@@ -651,6 +1019,21 @@ def download():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def remove_download_files(final_path, video_id):
+    """Eliminar el archivo enviado y los temporales de la descarga"""
+    try:
+        if os.path.exists(final_path):
+            os.remove(final_path)
+        # Limpiar cualquier archivo temporal
+        base_path = os.path.join(DOWNLOAD_FOLDER, video_id)
+        for ext in [".mp3", ".webm", ".m4a", "_temp", "_temp.mp3", ".mp4"]:
+            temp_file = f"{base_path}{ext}"
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    except Exception as e:
+        print(f"Error limpiando archivos: {e}")
+
+
 @app.route("/yt/download/<video_id>", methods=["GET"])
 def get_video(video_id):
     """Obtener el archivo descargado"""
@@ -668,9 +1051,7 @@ def get_video(video_id):
         # Obtener el título del video
         title = download_progress[video_id].get("title", "download")
         # Limpiar el título (mantener algunos caracteres especiales pero eliminar los problemáticos)
-        safe_title = "".join(
-            c for c in title if c.isalnum() or c in (" ", "-", "_", "|", ".")
-        ).rstrip()
+        safe_title = _UNSAFE_TITLE_CHARS.sub("", title).rstrip()
 
         is_audio = download_progress[video_id].get("is_audio", False)
         extension = ".mp3" if is_audio else ".mp4"
@@ -686,20 +1067,21 @@ def get_video(video_id):
             download_name=download_name,
         )
 
-        # Asegurar que el archivo se elimine después de enviarlo
-        @response.call_on_close
-        def on_close():
-            try:
-                if os.path.exists(final_path):
-                    os.remove(final_path)
-                # Limpiar cualquier archivo temporal
-                base_path = os.path.join(DOWNLOAD_FOLDER, video_id)
-                for ext in [".mp3", ".webm", ".m4a", "_temp", "_temp.mp3", ".mp4"]:
-                    temp_file = f"{base_path}{ext}"
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-            except Exception as e:
-                print(f"Error limpiando archivos: {e}")
+        # Eliminar el archivo solo tras enviarlo completo: las respuestas
+        # parciales (206, reanudaciones), 304 y HEAD lo conservan para que el
+        # cliente pueda volver a pedirlo; la limpieza periódica lo retira luego.
+        # send_file devuelve el file_wrapper tal cual (direct_passthrough), así
+        # que call_on_close no se ejecuta: se engancha al cierre del wrapper, que
+        # el servidor llama al terminar de enviar (también con sendfile)
+        if request.method == "GET" and response.status_code == 200:
+            body = response.response
+            close_body = body.close
+
+            def close():
+                close_body()
+                remove_download_files(final_path, video_id)
+
+            body.close = close
 
         return response
 
@@ -711,26 +1093,36 @@ def get_video(video_id):
 def cancel_download(video_id):
     """Endpoint para cancelar una descarga en progreso"""
     try:
-        if video_id not in download_progress:
-            return jsonify({"success": False, "error": "Descarga no encontrada"}), 404
+        with _STATE_LOCK:
+            if video_id not in download_progress:
+                return (
+                    jsonify({"success": False, "error": "Descarga no encontrada"}),
+                    404,
+                )
 
-        # Marcar la descarga para cancelación
-        download_cancel_flags[video_id] = True
+            # Marcar la descarga para cancelación
+            download_cancel_flags[video_id] = True
 
-        # Actualizar estado inmediatamente
-        download_progress[video_id].update(
-            {"status": "cancelling", "progress": 0, "error": "Cancelando descarga..."}
-        )
+            # Actualizar estado inmediatamente
+            download_progress[video_id].update(
+                {
+                    "status": "cancelling",
+                    "progress": 0,
+                    "error": "Cancelando descarga...",
+                }
+            )
+
+            # Cancelar la tarea si aún no ha empezado a ejecutarse
+            future = download_threads.get(video_id)
+            if future is not None:
+                future.cancel()
+
+            process = download_processes.pop(video_id, None)
 
         # Terminar procesos activos
-        if video_id in download_processes:
+        if process is not None:
             try:
-                process = download_processes[video_id]
-                import platform
-
                 if platform.system() == "Windows":
-                    import signal
-
                     try:
                         process.send_signal(signal.CTRL_BREAK_EVENT)
                     except:
@@ -746,43 +1138,44 @@ def cancel_download(video_id):
                         parent.kill()
             except Exception as e:
                 print(f"Error terminando proceso: {e}")
-            finally:
-                del download_processes[video_id]
 
         # Limpiar archivos existentes
         try:
-            base_path = os.path.join(DOWNLOAD_FOLDER, video_id)
-            patterns = [
-                f"video_{video_id}.*",
-                f"audio_{video_id}.*",
-                f"temp_video_{video_id}.*",
-                f"temp_audio_{video_id}.*",
-                f"{video_id}_final.*",
-                f"{video_id}_temp.*",
-            ]
-            import glob
-
-            for pattern in patterns:
-                for file in glob.glob(os.path.join(DOWNLOAD_FOLDER, pattern)):
-                    try:
-                        os.remove(file)
-                    except Exception as e:
-                        print(f"Error eliminando {file}: {e}")
+            prefixes = (
+                f"video_{video_id}",
+                f"audio_{video_id}",
+                f"temp_video_{video_id}",
+                f"temp_audio_{video_id}",
+                f"{video_id}_final",
+                f"{video_id}_temp",
+            )
+
+            # Recorrer el directorio una sola vez
+            with os.scandir(DOWNLOAD_FOLDER) as entries:
+                for entry in entries:
+                    if entry.name.startswith(prefixes):
+                        try:
+                            os.remove(entry.path)
+                        except Exception as e:
+                            print(f"Error eliminando {entry.path}: {e}")
         except Exception as e:
             print(f"Error limpiando archivos: {e}")
 
-        # Actualizar estado final
-        download_progress[video_id].update(
-            {
-                "status": "cancelled",
-                "progress": 0,
-                "error": "Descarga cancelada por el usuario",
-            }
-        )
+        with _STATE_LOCK:
+            # Actualizar estado final
+            if video_id in download_progress:
+                download_progress[video_id].update(
+                    {
+                        "status": "cancelled",
+                        "progress": 0,
+                        "error": "Descarga cancelada por el usuario",
+                    }
+                )
+
+            # Limpiar referencias
+            download_threads.pop(video_id, None)
 
-        # Limpiar referencias
-        if video_id in download_threads:
-            del download_threads[video_id]
+        notify_progress(video_id)
 
         return jsonify(
             {"success": True, "message": "Descarga cancelada", "status": "cancelled"}
@@ -799,29 +1192,24 @@ def cleanup_downloads():
         current_time = time.time()
 
         # Limpiar archivos
-        for filename in os.listdir(DOWNLOAD_FOLDER):
-            filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-            if os.path.getmtime(filepath) < current_time - 3600:
-                try:
-                    os.remove(filepath)
-                except Exception as e:
-                    print(f"Error eliminando {filepath}: {e}")
+        with os.scandir(DOWNLOAD_FOLDER) as entries:
+            for entry in entries:
+                if entry.stat().st_mtime < current_time - 3600:
+                    try:
+                        os.remove(entry.path)
+                    except Exception as e:
+                        print(f"Error eliminando {entry.path}: {e}")
 
         # Limpiar estados antiguos
-        video_ids = list(download_progress.keys())
-        for video_id in video_ids:
-            if video_id in download_progress:
-                status = download_progress[video_id].get("status")
-                if status in ["completed", "error", "cancelled"]:
+        with _STATE_LOCK:
+            for video_id, state in list(download_progress.items()):
+                if state.get("status") in ["completed", "error", "cancelled"]:
                     # Limpiar todos los estados relacionados
-                    if video_id in download_progress:
-                        del download_progress[video_id]
-                    if video_id in download_processes:
-                        del download_processes[video_id]
-                    if video_id in download_threads:
-                        del download_threads[video_id]
-                    if video_id in download_cancel_flags:
-                        del download_cancel_flags[video_id]
+                    download_progress.pop(video_id, None)
+                    download_processes.pop(video_id, None)
+                    download_threads.pop(video_id, None)
+                    download_cancel_flags.pop(video_id, None)
+                    progress_signals.pop(video_id, None)
 
     except Exception as e:
         print(f"Error en limpieza: {e}")
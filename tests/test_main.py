@@ -0,0 +1,315 @@
+import subprocess
+import threading
+import time
+
+import pytest
+import yt_dlp
+
+import main
+
+URL = "https://www.youtube.com/watch?v=test"
+
+
+def fake_info():
+    """Información procesada como la deja la selección de formato por defecto"""
+    formats = [
+        {
+            "format_id": "18",
+            "url": "http://x/c",
+            "ext": "mp4",
+            "vcodec": "avc1",
+            "acodec": "mp4a",
+            "height": 360,
+            "width": 640,
+        },
+        {
+            "format_id": "137",
+            "url": "http://x/v",
+            "ext": "mp4",
+            "vcodec": "avc1",
+            "acodec": "none",
+            "height": 1080,
+            "width": 1920,
+        },
+        {
+            "format_id": "140",
+            "url": "http://x/a",
+            "ext": "m4a",
+            "vcodec": "none",
+            "acodec": "mp4a",
+        },
+    ]
+    raw = {
+        "id": "test",
+        "title": "Test",
+        "formats": formats,
+        "extractor": "fake",
+        "extractor_key": "Fake",
+        "webpage_url": URL,
+    }
+    with yt_dlp.YoutubeDL(
+        {"quiet": True, "format": "bestvideo*+bestaudio/best"}
+    ) as ydl:
+        return ydl.process_ie_result(raw, download=False)
+
+
+@pytest.fixture
+def cached_info(monkeypatch):
+    info = fake_info()
+    assert "requested_formats" in info
+    monkeypatch.setitem(
+        main._INFO_CACHE,
+        URL,
+        (time.time(), info, main.index_formats(info["formats"])),
+    )
+    return info
+
+
+@pytest.fixture
+def downloaded(monkeypatch):
+    """Registrar los formatos que yt-dlp intentaría descargar"""
+    calls = []
+
+    def process_info(self, info_dict):
+        # process_info descarga requested_formats si existe
+        formats = info_dict.get("requested_formats") or [info_dict]
+        calls.append("+".join(f["format_id"] for f in formats))
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "process_info", process_info)
+    return calls
+
+
+@pytest.mark.parametrize("itag", ["140", "18", "137"])
+def test_download_uses_requested_itag_from_cached_info(cached_info, downloaded, itag):
+    client = main.app.test_client()
+    response = client.post("/yt/download", json={"url": URL, "itag": itag})
+    video_id = response.get_json()["video_id"]
+    main.download_threads[video_id].result(timeout=10)
+
+    expected = f"{itag}+140" if itag == "137" else itag
+    assert downloaded == [expected]
+
+
+def test_concurrent_cache_misses_extract_once(monkeypatch):
+    calls = []
+
+    def extract_info(self, url, download=True):
+        calls.append(url)
+        time.sleep(0.2)
+        return {"formats": []}
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "extract_info", extract_info)
+    monkeypatch.setattr(main, "_INFO_CACHE", {})
+
+    threads = [
+        threading.Thread(target=main._cached_extract, args=(URL,)) for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [URL]
+
+
+def test_merge_stages_download_their_own_format(cached_info, downloaded, monkeypatch):
+    def run_ffmpeg(ffmpeg_cmd, video_id):
+        return subprocess.CompletedProcess(ffmpeg_cmd, 0), ""
+
+    monkeypatch.setattr(main, "run_ffmpeg", run_ffmpeg)
+    monkeypatch.setattr(main, "probe_codec", lambda path, stream: None)
+    monkeypatch.setitem(main.download_progress, "stages", {"status": "starting"})
+
+    main.download_and_merge(URL, "137", "140", "out.mp4", "stages")
+
+    assert downloaded == ["137", "140"]
+
+
+@pytest.mark.parametrize("returncode, encoder", [(0, "h264_nvenc"), (1, "libx264")])
+def test_nvenc_requires_a_working_test_encode(monkeypatch, returncode, encoder):
+    commands = []
+
+    def run(cmd, **kwargs):
+        commands.append(cmd)
+        return subprocess.CompletedProcess(cmd, returncode)
+
+    monkeypatch.setattr(main.subprocess, "run", run)
+    monkeypatch.setattr(main, "_NVENC_AVAILABLE", None)
+
+    assert main.h264_encoder_args()[1] == encoder
+    assert main.h264_encoder_args(hardware=False)[1] == "libx264"
+    # El resultado de la prueba se guarda y no se repite
+    assert len(commands) == 1
+    assert "h264_nvenc" in commands[0]
+
+
+def test_format_indexes_keep_first_duplicate():
+    first = {"format_id": "18", "ext": "mp4"}
+    formats = [first, {"format_id": "18", "ext": "webm"}]
+    assert main.index_formats(formats)["18"] is first
+
+    processed = {"combined": [{"itag": "18"}], "videoOnly": [{"itag": "18"}]}
+    assert main.safe_get_format(processed, "18") is processed["combined"][0]
+
+
+def test_ensure_audio_video_format_uses_given_index(cached_info, monkeypatch):
+    formats = cached_info["formats"]
+    assert main.ensure_audio_video_format("137", formats) == "137+140"
+    assert main.ensure_audio_video_format("18", formats) == "18"
+
+    # Con un índice explícito no se vuelve a indexar la lista
+    formats_index = main.index_formats(formats)
+    monkeypatch.setattr(main, "index_formats", None)
+    assert main.ensure_audio_video_format("137", formats, formats_index) == "137+140"
+
+
+def test_download_merges_h264_and_aac_without_reencoding(cached_info, monkeypatch):
+    merger_args = []
+
+    def process_info(self, info_dict):
+        merger_args.append(self.params["postprocessor_args"]["merger"])
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "process_info", process_info)
+
+    client = main.app.test_client()
+    response = client.post("/yt/download", json={"url": URL, "itag": "137"})
+    video_id = response.get_json()["video_id"]
+    main.download_threads[video_id].result(timeout=10)
+
+    assert merger_args == [["-c:v", "copy", "-c:a", "copy"]]
+
+
+def test_combined_download_skips_merge_args(cached_info, monkeypatch):
+    params = []
+
+    def process_info(self, info_dict):
+        params.append(self.params)
+
+    def has_nvenc():
+        raise AssertionError("no hace falta probar NVENC sin merge")
+
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "process_info", process_info)
+    monkeypatch.setattr(main, "has_nvenc", has_nvenc)
+
+    client = main.app.test_client()
+    response = client.post("/yt/download", json={"url": URL, "itag": "18"})
+    video_id = response.get_json()["video_id"]
+    main.download_threads[video_id].result(timeout=10)
+
+    assert "merger" not in params[0].get("postprocessor_args", {})
+
+
+def test_concurrent_nvenc_checks_probe_once(monkeypatch):
+    commands = []
+
+    def run(cmd, **kwargs):
+        commands.append(cmd)
+        time.sleep(0.2)
+        return subprocess.CompletedProcess(cmd, 0)
+
+    monkeypatch.setattr(main.subprocess, "run", run)
+    monkeypatch.setattr(main, "_NVENC_AVAILABLE", None)
+
+    threads = [threading.Thread(target=main.has_nvenc) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(commands) == 1
+
+
+def test_merge_falls_back_to_libx264_when_nvenc_fails(cached_info, monkeypatch):
+    commands = []
+
+    def run_ffmpeg(ffmpeg_cmd, video_id):
+        commands.append(ffmpeg_cmd)
+        returncode = 1 if len(commands) == 1 else 0
+        return subprocess.CompletedProcess(ffmpeg_cmd, returncode), ""
+
+    monkeypatch.setattr(main, "run_ffmpeg", run_ffmpeg)
+    monkeypatch.setattr(main, "probe_codec", lambda path, stream: "vp9")
+    monkeypatch.setattr(main, "_NVENC_AVAILABLE", True)
+    monkeypatch.setattr(yt_dlp.YoutubeDL, "process_info", lambda self, info: None)
+    monkeypatch.setitem(main.download_progress, "merge", {"status": "starting"})
+
+    main.download_and_merge(URL, "137", "140", "out.mp4", "merge")
+
+    assert [cmd[cmd.index("-c:v") + 1] for cmd in commands] == [
+        "h264_nvenc",
+        "libx264",
+    ]
+    assert main.download_progress["merge"]["status"] == "completed"
+
+
+def test_progress_stream_sends_keepalives_and_changes(monkeypatch):
+    monkeypatch.setattr(main, "PROGRESS_STREAM_KEEPALIVE", 0.05)
+    monkeypatch.setitem(main.download_progress, "sse", {"status": "starting"})
+
+    client = main.app.test_client()
+    response = client.get("/yt/progress/sse/stream")
+    chunks = response.iter_encoded()
+
+    assert next(chunks) == b'data: {"status":"starting"}\n\n'
+    assert next(chunks) == b": keepalive\n\n"
+
+    main.download_progress["sse"] = {"status": "completed"}
+    main.notify_progress("sse")
+    assert next(chunks) == b'data: {"status":"completed"}\n\n'
+    assert list(chunks) == []
+    assert "sse" not in main.progress_signals
+
+
+def test_progress_stream_has_a_maximum_lifetime(monkeypatch):
+    monkeypatch.setattr(main, "PROGRESS_STREAM_KEEPALIVE", 0.01)
+    monkeypatch.setattr(main, "PROGRESS_STREAM_MAX_SECONDS", 0.05)
+    monkeypatch.setitem(main.download_progress, "stalled", {"status": "starting"})
+
+    response = main.app.test_client().get("/yt/progress/stalled/stream")
+    chunks = list(response.iter_encoded())
+
+    assert chunks[0] == b'data: {"status":"starting"}\n\n'
+    assert set(chunks[1:]) <= {b": keepalive\n\n"}
+    assert "stalled" not in main.progress_signals
+
+
+def test_progress_stream_does_not_register_unknown_ids():
+    client = main.app.test_client()
+    for i in range(3):
+        response = client.get(f"/yt/progress/bogus{i}/stream")
+        assert response.get_data() == b'data: {"status":"not_found"}\n\n'
+
+    assert not any(key.startswith("bogus") for key in main.progress_signals)
+
+
+def test_progress_stream_unregisters_when_client_disconnects(monkeypatch):
+    monkeypatch.setitem(main.download_progress, "gone", {"status": "starting"})
+
+    response = main.app.test_client().get("/yt/progress/gone/stream")
+    chunks = response.iter_encoded()
+    next(chunks)
+    assert main.progress_signals["gone"].subscribers == 1
+
+    response.close()
+    assert "gone" not in main.progress_signals
+
+
+def test_partial_responses_keep_the_downloaded_file(tmp_path, monkeypatch):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"0123456789")
+    monkeypatch.setitem(
+        main.download_progress,
+        "served",
+        {"status": "completed", "final_path": str(path), "title": "Test"},
+    )
+    client = main.app.test_client()
+
+    response = client.get("/yt/download/served", headers={"Range": "bytes=0-3"})
+    assert response.status_code == 206
+    response.close()
+    assert path.exists()
+
+    response = client.get("/yt/download/served")
+    assert response.status_code == 200
+    response.close()
+    assert not path.exists()